@@ -1,8 +1,23 @@
 from PIL import Image
+import numpy as np
 
+import io
 import os
 import argparse
 import sys
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import cv2  # optional, rotates frames faster than PIL
+except ImportError:
+    cv2 = None
+
+try:
+    from numba import njit  # optional, compiles the pixel remap into a single pass
+except ImportError:
+    njit = None
 
 # Transparency issue solved by egocarib in included code, found at https://gist.github.com/egocarib/ea022799cca8a102d14c54a22c45efe0.
 
@@ -14,9 +29,40 @@ import sys
 # This code works around the issue and allows us to properly generate transparent GIFs.
 
 from typing import Tuple, List, Union
-from collections import defaultdict
-from random import randrange
-from itertools import chain
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _find_used_palette_idxs(data, alpha_mask):
+        """Return a flag per palette index, set if any unmasked pixel of `data` uses it."""
+        used = np.zeros(256, dtype=np.bool_)
+        for idx in range(data.size):
+            if not alpha_mask[idx]:
+                used[data[idx]] = True
+        return used
+
+    @njit(cache=True)
+    def _remap_pixels(data, alpha_mask, trans_table):
+        """Return `data` passed through `trans_table`, with the masked pixels set to 0."""
+        remapped = np.empty_like(data)
+        for idx in range(data.size):
+            remapped[idx] = 0 if alpha_mask[idx] else trans_table[data[idx]]
+        return remapped
+else:
+    def _find_used_palette_idxs(data, alpha_mask):
+        """Return a flag per palette index, set if any unmasked pixel of `data` uses it."""
+        return np.bincount(data[~alpha_mask], minlength=256) > 0
+
+    def _remap_pixels(data, alpha_mask, trans_table):
+        """Return `data` passed through `trans_table`, with the masked pixels set to 0."""
+        remapped = trans_table[data]
+        remapped[alpha_mask] = 0
+        return remapped
+
+
+def _has_transparent_index(img: Image.Image) -> bool:
+    """Return whether `img` is a mode `P` `Image` with a single transparent palette index."""
+    return img.mode == 'P' and isinstance(img.info.get('transparency'), int)
 
 
 class TransparentAnimatedGifConverter(object):
@@ -28,35 +74,27 @@ class TransparentAnimatedGifConverter(object):
 
     def _process_pixels(self):
         """Set the transparent pixels to the color 0."""
-        self._transparent_pixels = set(
-            idx for idx, alpha in enumerate(
-                self._img_rgba.getchannel(channel='A').getdata())
-            if alpha <= self._alpha_threshold)
+        alpha = np.asarray(self._img_rgba.getchannel(channel='A'))
+        self._alpha_mask = (alpha <= self._alpha_threshold).ravel()
 
     def _set_parsed_palette(self):
         """Parse the RGB palette color `tuple`s from the palette."""
-        palette = self._img_p.getpalette()
-        self._img_p_used_palette_idxs = set(
-            idx for pal_idx, idx in enumerate(self._img_p_data)
-            if pal_idx not in self._transparent_pixels)
+        palette = np.array(self._img_p.getpalette(), dtype=np.uint8).reshape(-1, 3)
+        used_palette_idxs = np.flatnonzero(_find_used_palette_idxs(self._img_p_data, self._alpha_mask))
+        self._img_p_used_palette_idxs = set(used_palette_idxs.tolist())
         self._img_p_parsedpalette = dict(
-            (idx, tuple(palette[idx * 3:idx * 3 + 3]))
-            for idx in self._img_p_used_palette_idxs)
+            zip(used_palette_idxs.tolist(), map(tuple, palette[used_palette_idxs].tolist())))
+        # Updated as colors are added, so `_get_unused_color` need not rebuild it. Remapping index 0 only
+        # moves a color; a color it leaves unused stays in the set, which just rules out one more candidate.
+        self._used_colors = set(self._img_p_parsedpalette.values())
 
     def _get_similar_color_idx(self):
         """Return a palette index with the closest similar color."""
-        old_color = self._img_p_parsedpalette[0]
-        dict_distance = defaultdict(list)
-        for idx in range(1, 256):
-            color_item = self._img_p_parsedpalette[idx]
-            if color_item == old_color:
-                return idx
-            distance = sum((
-                abs(old_color[0] - color_item[0]),  # Red
-                abs(old_color[1] - color_item[1]),  # Green
-                abs(old_color[2] - color_item[2])))  # Blue
-            dict_distance[distance].append(idx)
-        return dict_distance[sorted(dict_distance)[0]][0]
+        old_color = np.array(self._img_p_parsedpalette[0], dtype=np.int16)
+        colors = np.array(
+            [self._img_p_parsedpalette[idx] for idx in range(1, 256)], dtype=np.int16)
+        distances = np.abs(colors - old_color).sum(axis=1)  # Red + Green + Blue
+        return int(distances.argmin()) + 1
 
     def _remap_palette_idx_zero(self):
         """Since the first color is used in the palette, remap it."""
@@ -71,11 +109,13 @@ class TransparentAnimatedGifConverter(object):
 
     def _get_unused_color(self) -> tuple:
         """ Return a color for the palette that does not collide with any other already in the palette."""
-        used_colors = set(self._img_p_parsedpalette.values())
-        while True:
-            new_color = (randrange(256), randrange(256), randrange(256))
-            if new_color not in used_colors:
-                return new_color
+        used_colors = self._used_colors
+        # 256 * 3 * 3 candidates, more than the 256 colors a palette can hold
+        for red in range(256):
+            for green in (0, 128, 255):
+                for blue in (0, 128, 255):
+                    if (red, green, blue) not in used_colors:
+                        return red, green, blue
 
     def _process_palette(self):
         """Adjust palette to have the zeroth color set as transparent. Basically, get another palette
@@ -84,29 +124,57 @@ class TransparentAnimatedGifConverter(object):
         if 0 in self._img_p_used_palette_idxs:
             self._remap_palette_idx_zero()
         self._img_p_parsedpalette[0] = self._get_unused_color()
+        self._used_colors.add(self._img_p_parsedpalette[0])
 
     def _adjust_pixels(self):
         """Convert the pixels into their new values."""
-        if self._palette_replaces['idx_from']:
-            trans_table = bytearray.maketrans(
-                bytes(self._palette_replaces['idx_from']),
-                bytes(self._palette_replaces['idx_to']))
-            self._img_p_data = self._img_p_data.translate(trans_table)
-        for idx_pixel in self._transparent_pixels:
-            self._img_p_data[idx_pixel] = 0
-        self._img_p.frombytes(data=bytes(self._img_p_data))
+        trans_table = np.arange(256, dtype=np.uint8)
+        trans_table[self._palette_replaces['idx_from']] = self._palette_replaces['idx_to']
+        img_p_data = _remap_pixels(self._img_p_data, self._alpha_mask, trans_table)
+        self._img_p.frombytes(data=img_p_data)
 
     def _adjust_palette(self):
         """Modify the palette in the new `Image`."""
-        unused_color = self._get_unused_color()
-        final_palette = chain.from_iterable(
-            self._img_p_parsedpalette.get(x, unused_color) for x in range(256))
-        self._img_p.putpalette(data=final_palette)
+        final_palette = np.empty((256, 3), dtype=np.uint8)
+        final_palette[:] = self._get_unused_color()
+        final_palette[list(self._img_p_parsedpalette)] = list(self._img_p_parsedpalette.values())
+        self._img_p.putpalette(data=final_palette.tobytes())
+
+    def _process_indexed(self) -> Image.Image:
+        """Return a copy of the mode `P` `Image` with its transparent index moved to 0, keeping its palette
+        so that frames sharing a palette still share it afterwards."""
+        transparency = self._img_rgba.info['transparency']
+        self._img_p = self._img_rgba.copy()
+        img_p_data = np.frombuffer(self._img_p.tobytes(), dtype=np.uint8)
+        source_palette = np.array(self._img_p.getpalette(), dtype=np.uint8).reshape(-1, 3)
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        palette[:len(source_palette)] = source_palette
+        # Swap the transparent index with 0, in the pixels and in the palette
+        trans_table = np.arange(256, dtype=np.uint8)
+        trans_table[[0, transparency]] = [transparency, 0]
+        palette[[0, transparency]] = palette[[transparency, 0]]
+        self._used_colors = set(map(tuple, palette[1:].tolist()))
+        palette[0] = self._get_unused_color()
+        # Point entries that repeat a color at its first entry and give them a new color, so that every
+        # entry is distinct and PIL can write the palette once for all frames
+        _, first_idxs, color_idxs = np.unique(palette, axis=0, return_index=True, return_inverse=True)
+        first_idxs = first_idxs[color_idxs.ravel()].astype(np.uint8)
+        trans_table = first_idxs[trans_table]
+        for idx in np.flatnonzero(first_idxs != np.arange(256)):
+            palette[idx] = self._get_unused_color()
+            self._used_colors.add(tuple(palette[idx].tolist()))
+        self._img_p.frombytes(data=_remap_pixels(img_p_data, img_p_data == transparency, trans_table))
+        self._img_p.putpalette(data=palette.tobytes())
+        self._img_p.info['transparency'] = 0
+        self._img_p.info['background'] = 0
+        return self._img_p
 
     def process(self) -> Image.Image:
         """Return the processed mode `P` `Image`."""
+        if _has_transparent_index(self._img_rgba):
+            return self._process_indexed()
         self._img_p = self._img_rgba.convert(mode='P')
-        self._img_p_data = bytearray(self._img_p.tobytes())
+        self._img_p_data = np.frombuffer(self._img_p.tobytes(), dtype=np.uint8)
         self._palette_replaces = dict(idx_from=list(), idx_to=list())
         self._process_pixels()
         self._process_palette()
@@ -118,19 +186,25 @@ class TransparentAnimatedGifConverter(object):
 
 
 def create_animated_gif(images: List[Image.Image], durations: Union[int, List[int]]) -> Tuple[Image.Image, dict]:
-    """If the image is a GIF, create an its thumbnail here."""
+    """Convert the frames to transparent mode `P` images, returning the first frame and the GIF save arguments."""
     save_kwargs = dict()
     new_images: List[Image.Image] = []
+    converted_frames = dict()  # the same frame object may appear several times, e.g. when reversing
 
     for frame in images:
-        thumbnail = frame.copy()  # type: Image.Image
-        thumbnail_rgba = thumbnail.convert(mode='RGBA')
-        thumbnail_rgba.thumbnail(size=frame.size, reducing_gap=3.0)
-        converter = TransparentAnimatedGifConverter(img_rgba=thumbnail_rgba)
-        thumbnail_p = converter.process()  # type: Image.Image
-        new_images.append(thumbnail_p)
+        if id(frame) not in converted_frames:
+            if frame.mode == 'RGBA' or _has_transparent_index(frame):
+                frame_rgba = frame
+            else:
+                frame_rgba = frame.convert(mode='RGBA')
+            converter = TransparentAnimatedGifConverter(img_rgba=frame_rgba)
+            converted_frames[id(frame)] = converter.process()  # type: Image.Image
+        new_images.append(converted_frames[id(frame)])
 
     output_image = new_images[0]
+    palette = output_image.getpalette()
+    if all(frame.getpalette() == palette for frame in converted_frames.values()):
+        save_kwargs.update(palette=bytes(palette))  # write the shared palette once, not once per frame
     save_kwargs.update(
         format='GIF',
         save_all=True,
@@ -142,11 +216,31 @@ def create_animated_gif(images: List[Image.Image], durations: Union[int, List[in
     return output_image, save_kwargs
 
 
+def _save_gif_with_gifsicle(images: List[Image.Image], durations: Union[int, List[int]], save_file):
+    """Pass the frames to gifsicle as single-image GIFs, which assembles and optimizes the animation."""
+    if not isinstance(durations, list):
+        durations = [durations] * len(images)
+    elif len(durations) < len(images):
+        raise ValueError(f"Got {len(durations)} durations for {len(images)} frames.")
+    root_frame, save_args = create_animated_gif(images, durations)
+    frames = [root_frame] + save_args['append_images']
+    frames_gif = io.BytesIO()
+    for frame, duration in zip(frames, durations):
+        frame.save(frames_gif, format='GIF', optimize=False, duration=duration, disposal=2)
+    subprocess.run(
+        ['gifsicle', '--merge', '--multifile', '-O3', '--disposal=background', '--loopcount=forever',
+         '-o', os.fspath(save_file), '-'],
+        input=frames_gif.getvalue(), check=True)
+
+
 def save_transparent_gif(images: List[Image.Image], durations: Union[int, List[int]], save_file):
     """Creates a transparent GIF, adjusting to avoid transparency issues that are present in the PIL library
 
     Note that this does NOT work for partial alpha. The partial alpha gets discarded and replaced by solid colors.
 
+    If gifsicle is installed and `save_file` is a path, the frames are piped to gifsicle, which writes an
+    optimized GIF in the same pass.
+
     Parameters:
         images: a list of PIL Image objects that compose the GIF frames
         durations: an int or List[int] that describes the animation durations for the frames of this GIF
@@ -155,12 +249,52 @@ def save_transparent_gif(images: List[Image.Image], durations: Union[int, List[i
     Returns:
         Image - The PIL Image object (after first saving the image to the specified target)
     """
+    if isinstance(save_file, (str, os.PathLike)) and shutil.which('gifsicle') is not None:
+        _save_gif_with_gifsicle(images, durations, save_file)
+        return
     root_frame, save_args = create_animated_gif(images, durations)
     root_frame.save(save_file, **save_args)
 
 # The above was written by egocarib https://gist.github.com/egocarib/ea022799cca8a102d14c54a22c45efe0
 # The following is original work by Arcanewinds.
 
+_frame_source = None
+
+
+def _init_frame_worker(im_p, alpha):
+    """Keep the source image in each worker process, so it is only sent once per worker."""
+    global _frame_source
+    _frame_source = (im_p, alpha)
+    if cv2 is not None:
+        cv2.setNumThreads(1)  # frames are already spread across processes
+
+
+def _rotate(im, angle):
+    """Rotate `im` counter-clockwise by `angle` degrees like `Image.rotate`, using OpenCV if installed."""
+    if cv2 is None:
+        return im.rotate(angle)
+    width, height = im.size
+    # PIL rotates about the centre of the pixel grid, which is (w-1)/2, (h-1)/2 in OpenCV pixel coordinates.
+    matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+    rotated = cv2.warpAffine(np.asarray(im), matrix, (width, height), flags=cv2.INTER_NEAREST,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+    rotated_im = Image.fromarray(rotated)
+    if im.mode == 'P':
+        rotated_im.putpalette(im.getpalette())
+    return rotated_im
+
+
+def _render_frame(angle):
+    """Rotate the quantized source image by `angle` and return it as a transparent palette frame."""
+    im_p, alpha = _frame_source
+    rotated_im = _rotate(im_p, angle)
+    alpha = _rotate(alpha, angle)
+    mask = Image.fromarray(np.where(np.asarray(alpha) <= 128, 255, 0).astype(np.uint8))  # transparency mask
+    rotated_im.paste(255, mask)  # add transparency
+    rotated_im.info['transparency'] = 255  # encode transparency value
+    return rotated_im
+
+
 def generate_rollin_gif(src_filename, output_filename=None, fps=50, gif_time=2, clockwise=1, size=None, speed='linear', reverse=0, num_rotations=1):
     PROG_RESOLUTION = 10  # resolution of progress indicator
     src_filename, file_ext = src_filename.split('.')
@@ -192,9 +326,9 @@ def generate_rollin_gif(src_filename, output_filename=None, fps=50, gif_time=2,
     else:
         raise ValueError(f"Speed \'{speed}\' not recognised.")
 
-    filenames = []
     progress_ids = [int((x / PROG_RESOLUTION) * num_images)-1 for x in list(range(1, PROG_RESOLUTION + 1, 1))]
     progress_percentages = [((x / PROG_RESOLUTION) * 100) for x in list(range(1, PROG_RESOLUTION + 1, 1))]
+    progress_map = dict(zip(reversed(progress_ids), reversed(progress_percentages)))  # first percentage wins
     if clockwise == 1:
         print('Clockwise rotation.')
         direction = -1
@@ -202,43 +336,38 @@ def generate_rollin_gif(src_filename, output_filename=None, fps=50, gif_time=2,
         print('Anti-clockwise rotation.')
         direction = 1
 
-    created_png = False
-    if not file_ext == '.png':
-        im = im.convert('RGBA')
-        created_png = True
-        im.save(src_filename+'.png', format='PNG', optimize=True)
-        file_ext = '.png'
-        im = Image.open(src_filename + file_ext)
-    else:
-        im = im.convert('RGBA')
+    im = im.convert('RGBA')
     if size is not None:
-        print(f"Resizing {src_filename}.{file_ext} to {size}.")
+        print(f"Resizing {src_filename}{file_ext} to {size}.")
         im = im.resize(size)
     print('Generating '+str(num_images)+' images.')
     rollin_images = []
+    angles = []
     cum_deg_step = 0
     for i in range(num_images):
         #angle = direction * (i * deg_step)
         if speed == 'linear':
             angle = direction * (i * deg_step)
-            rotated_im = im.rotate(angle)
         else:
             angle = direction * cum_deg_step  # cum_deg_step
-            rotated_im = im.rotate(angle)
             if i < (num_images - 1):
                 cum_deg_step += deg_step[i]  # cumulative
-        if file_ext == '.png':
-            alpha = rotated_im.getchannel('A')  # isolate transparency
-            rotated_im = rotated_im.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
-            mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)  # transparency mask
-            rotated_im.paste(255, mask)  # add transparency
-            rotated_im.info['transparency'] = 255  # encode transparency value
-        rollin_images.append(rotated_im)
-        # this_filename = src_filename+f'_{i}'+file_ext
-        # rotated_im.save(this_filename, optimize=False)
-        # filenames.append(this_filename)
-        if i in progress_ids:
-            print(f'Generating images: {progress_percentages[progress_ids.index(i)]}% complete.')
+        angles.append(angle)
+    # Quantize once, so every frame shares the same palette
+    alpha = im.getchannel('A')  # isolate transparency
+    im_p = im.convert('RGB').quantize(colors=255, method=Image.Quantize.FASTOCTREE)
+    with ProcessPoolExecutor(initializer=_init_frame_worker, initargs=(im_p, alpha)) as executor:
+        rotated_cache = {}  # frames already generated, keyed by angle modulo 360
+        for angle in angles:
+            angle_key = round(angle % 360, 3)
+            if angle_key not in rotated_cache:
+                rotated_cache[angle_key] = executor.submit(_render_frame, angle)
+        for i, angle in enumerate(angles):
+            rotated_im = rotated_cache[round(angle % 360, 3)].result()
+            rollin_images.append(rotated_im)
+            progress_percentage = progress_map.get(i)
+            if progress_percentage is not None:
+                print(f'Generating images: {progress_percentage}% complete.')
 
     if output_filename is None:
         output_filename = src_filename+'.gif'
@@ -254,31 +383,27 @@ def generate_rollin_gif(src_filename, output_filename=None, fps=50, gif_time=2,
     max_dur = avg_dur + (avg_dur - min_dur)
     if speed == 'increasing':
         print('Incrementally increasing rotation velocity.')
-        durations = [int((x * ((max_dur - min_dur) / num_images)) + min_dur) for x in range(num_images, -1, -1)]
+        durations = (np.arange(num_images, -1, -1) * ((max_dur - min_dur) / num_images) + min_dur).astype(int)
     elif speed == 'decreasing':
         print('Incrementally decreasing rotation velocity.')
-        durations = [int((x * ((max_dur - min_dur) / num_images)) + min_dur) for x in range(num_images)]
+        durations = (np.arange(num_images) * ((max_dur - min_dur) / num_images) + min_dur).astype(int)
     else:
         print('Linear rotation velocity.')
         durations = max([int((gif_time/num_images)*1000), 20])
     if reverse == 1:
         print('Adding reverse order images.')
-        for i in range(num_images - 1, -1, -1):
-            rollin_images.append(rollin_images[i])
-            if isinstance(durations, list):
-                durations.append(durations[i])
-    print('Converting images to .gif')
+        rollin_images += rollin_images[num_images - 1::-1]
+        if isinstance(durations, np.ndarray):
+            durations = np.concatenate([durations, durations[num_images - 1::-1]])
+    if isinstance(durations, np.ndarray):
+        durations = durations.tolist()
+    if shutil.which('gifsicle') is not None:
+        print('Converting images to optimized .gif')
+    else:
+        print('Converting images to .gif')
+        print('For file-size optimized .gifs, install gifsicle.')
     save_transparent_gif(rollin_images, durations, output_filename)
 
-    try:
-        from pygifsicle import optimize
-        print('Optimizing .gif')
-        optimize(src_filename+'.gif')
-    except ImportError:
-        print('For file-size optimized .gifs, install pygifsicle.')
-
-    if created_png:
-        os.remove(src_filename+'.png')
     print('Rollin .gif generated: '+output_filename)
 
     return src_filename+'.gif'